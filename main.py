@@ -1,21 +1,54 @@
 import os
-import json
+import math
+import time
+import asyncio
+import re
+import hashlib
 import logging
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, field_validator
+from fastapi.openapi.utils import get_openapi
 from dotenv import load_dotenv
-from groq import Groq
+import httpx
+import msgspec
+import orjson
+from groq import APIStatusError, AsyncGroq, RateLimitError
 
 # --- 1. SETUP ---
 load_dotenv()
-logging.basicConfig(level=logging.INFO)
+# WARNING em produção; LOG_LEVEL=INFO/DEBUG para investigar (valor desconhecido cai em WARNING)
+LOG_LEVEL = logging.getLevelName(os.getenv("LOG_LEVEL", "WARNING").upper())
+logging.basicConfig(level=LOG_LEVEL if isinstance(LOG_LEVEL, int) else logging.WARNING)
 logger = logging.getLogger(__name__)
 
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Cada worker do uvicorn é um processo independente (WEB_CONCURRENCY é a mesma variável lida pelo uvicorn).
+# Um `uvicorn main:app` simples roda em um processo só; o __main__ exporta a variável para os workers que cria
+WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
 
-app = FastAPI(title="Analista de RNC Expert v2.5")
+client: Optional[AsyncGroq] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Um único pool HTTP/2 reaproveita conexões TLS com api.groq.com entre requisições
+    global client
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+        timeout=httpx.Timeout(60, connect=5)
+    )
+    # Sem retries internos do SDK: as novas tentativas passam pelo token bucket em _chamar_ia
+    client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"), http_client=http_client, max_retries=0)
+    yield
+    await client.close()
+    await http_client.aclose()
+
+app = FastAPI(title="Analista de RNC Expert v2.5", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,7 +59,9 @@ app.add_middleware(
 )
 
 # --- 2. MODELOS ---
-class Rnc(BaseModel):
+# Structs do msgspec: decodificação direto dos bytes da requisição, sem passar pelo Pydantic.
+# Rnc usa layout fixo (slots), é imutável e fica fora do GC cíclico: menos memória por registro
+class Rnc(msgspec.Struct, kw_only=True, frozen=True, gc=False):
     RNC: str
     ANO: str
     PRIORIDADE: str
@@ -40,119 +75,535 @@ class Rnc(BaseModel):
     CONCLUSAO: Optional[str] = None
     DEPARTAMENTO_DESTINO: str
 
-    @field_validator('*', mode='before')
-    @classmethod
-    def trim_string(cls, v):
-        if isinstance(v, str):
-            return v.strip()
-        return v
-
-class RequisicaoAnalista(BaseModel):
+class RequisicaoAnalista(msgspec.Struct):
     dados_rnc: List[Rnc]
 
-# --- 3. LOGICA PRINCIPAL COM FILTRO DE DADOS ---
-@app.post("/analise-rnc")
-async def analise_rnc(payload: RequisicaoAnalista):
-    # FILTRO PREVENTIVO: Se não há dados, retornamos a resposta fixa sem chamar a IA
-    if not payload.dados_rnc or len(payload.dados_rnc) == 0:
-        logger.info("Sistema estável: 0 RNCs processadas.")
-        return {
-            "resumo_geral": "Não foram identificados registros de Não Conformidade (RNC) para os parâmetros selecionados. Os processos operam dentro da normalidade estatística.",
-            "principais_causas": ["Operação estável"],
-            "analise_de_risco": "baixo",
-            "sugestao_plano_acao": "Manter protocolos de monitoramento preventivo.",
-            "estatisticas": {
-                "total_analisado": 0,
-                "status_predominante": "N/A"
-            }
-        }
+# Esquema que a IA deve devolver: o decoder recusa campo faltando ou de tipo errado antes de consolidar
+class Parecer(msgspec.Struct, frozen=True):
+    resumo_geral: str
+    principais_causas: List[str]
+    analise_de_risco: str
+    sugestao_plano_acao: str
+
+_DECODER = msgspec.json.Decoder(RequisicaoAnalista)
+_DECODER_PARECER = msgspec.json.Decoder(Parecer)
+_ENCODER = msgspec.json.Encoder()
+
+# O endpoint lê o corpo cru, então o schema do msgspec é publicado no OpenAPI manualmente (/docs continua utilizável)
+(_SCHEMA_REQUISICAO,), _SCHEMAS_COMPONENTES = msgspec.json.schema_components(
+    [RequisicaoAnalista], ref_template="#/components/schemas/{name}"
+)
+
+def _openapi() -> dict:
+    if app.openapi_schema is None:
+        schema = get_openapi(title=app.title, version=app.version, routes=app.routes)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(_SCHEMAS_COMPONENTES)
+        app.openapi_schema = schema
+    return app.openapi_schema
+
+app.openapi = _openapi
+
+_RE_CAMINHO = re.compile(r"\[(\d+)\]|\.(\w+)")
+_RE_CAMPO_FALTANDO = re.compile(r"missing required field `(\w+)`")
+
+def _erros_validacao(e: msgspec.DecodeError) -> List[dict]:
+    # Mesmo formato do 422 padrão do FastAPI: lista de erros com "loc" a partir de "body"
+    mensagem, _, caminho = str(e).partition(" - at `$")
+    loc: List = ["body"]
+    for indice, campo in _RE_CAMINHO.findall(caminho.rstrip("`")):
+        loc.append(int(indice) if indice else campo)
+    faltando = _RE_CAMPO_FALTANDO.search(mensagem)
+    if faltando:
+        loc.append(faltando.group(1))
+    tipo = "value_error" if isinstance(e, msgspec.ValidationError) else "json_invalid"
+    return [{"type": tipo, "loc": loc, "msg": mensagem, "input": None}]
+
+def _normalizar(rncs: List[Rnc]) -> Tuple[List[Rnc], str]:
+    # Uma única passada: apara os textos e já conta os status para a estatística local.
+    # Como Rnc é imutável, só os registros com espaços sobrando são recriados
+    contagem_status = Counter()
+    normalizadas = []
+    for r in rncs:
+        aparados = {}
+        for campo in r.__struct_fields__:
+            v = getattr(r, campo)
+            if isinstance(v, str):
+                aparado = v.strip()
+                if len(aparado) != len(v):
+                    aparados[campo] = aparado
+        if aparados:
+            r = msgspec.structs.replace(r, **aparados)
+        normalizadas.append(r)
+        if r.STATUS:
+            contagem_status[r.STATUS.upper()] += 1
+    mais_comum = contagem_status.most_common(1)
+    return normalizadas, mais_comum[0][0] if mais_comum else "NAO_INFORMADO"
+
+# --- 3. PROMPTS ---
+# Texto fixo no início e dados variáveis no fim: o prefixo idêntico entre requisições
+# aproveita o cache de prompt da Groq e reduz o TTFT
+_SYSTEM_PROMPT = """\
+Você é um Auditor ISO 9001 Sênior (perfil analítico e independente).
+Seu objetivo é produzir um parecer técnico robusto, rastreável e baseado estritamente nos dados de RNC fornecidos.
+
+Postura e regras:
+- Extraia fatos objetivos e padrões; não aceite explicações vagas.
+- Evite respostas genéricas: tudo deve estar ancorado em informações presentes nos dados.
+- Diferencie falha pontual vs. falha sistêmica (processo/controle).
+- Identifique tendências (recorrência por cliente, produto, etapa, motivo, setor, fornecedor, turno, operador, máquina, lote, data, ou qualquer marcador existente).
+- Se algum campo crítico estiver ausente/ambíguo, registre explicitamente a limitação e o impacto disso na análise (sem inventar dados).
+- Linguagem técnica e clara, sem jargões vazios.
+- Saída obrigatória: JSON puro, sem texto fora do JSON.
+"""
+
+_USER_PROMPT_TMPL = """\
+Analise detalhadamente os dados de RNC que estão ao final desta mensagem.
+
+INSTRUÇÕES OBRIGATÓRIAS PARA O PARECER:
+1) Em 'resumo_geral':
+- Escreva no mínimo 2 parágrafos.
+- Conecte fatos entre si (o que aconteceu, onde se repete, qual o padrão, qual o indício de falha de processo).
+- Cite explicitamente os códigos de produto e os clientes mencionados nos dados (nomes/códigos conforme aparecerem).
+- Aponte recorrências e padrões com base em evidências dos dados (ex.: “ocorreu X vezes”, “repetiu em datas/lotes/OPs diferentes”, “concentrado em um cliente/produto”).
+- Se os dados não permitirem afirmar recorrência, diga isso claramente e explique o que faltou.
+- Ignore RNC com status "Registrada".
+
+2) Em 'principais_causas':
+- Liste somente causas que apareçam nos dados (causa informada, descrição de falha, etapa do processo, evidência repetida).
+- Escreva causas como frases objetivas e auditáveis (ex.: “Falta de inspeção final registrada”, “Parâmetro de processo fora do padrão”, “Matéria-prima fora de especificação”).
+- Não invente causa raiz; se a causa estiver indefinida, registre como “Causa não determinada nos registros” e explique no resumo.
+
+3) Em 'analise_de_risco':
+- Classifique como "baixo", "medio" ou "alto" com base nos próprios dados.
+- Justifique no texto (dentro do campo) considerando: recorrência, impacto no cliente, possibilidade de escape, severidade do defeito, status da RNC (aberta/fechada), e repetição por produto/cliente/lote/OP, quando houver.
+
+4) Em 'sugestao_plano_acao':
+- Proponha passos práticos e verificáveis, derivados das falhas relatadas e das lacunas de controle percebidas nos dados.
+- Não cite requisitos da norma por número; descreva ações de forma operacional (ex.: “revisar ponto de controle X”, “reforçar critério de aceite”, “criar verificação de registro”, “bloquear lote até evidência”, etc.).
+- Se não houver dados suficientes para um plano específico, proponha ações de coleta de evidência (ex.: “levantar histórico por produto/cliente”, “estratificar por causa/status”).
+
+IMPORTANTE:
+- Não use bullet points fora do JSON.
+- Não retorne markdown.
+- Não inclua comentários.
+- Não inclua campos extras.
+
+Retorne EXCLUSIVAMENTE em JSON, exatamente com este esquema e tipos:
+{{
+"resumo_geral": "string",
+"principais_causas": ["string", "string"],
+"analise_de_risco": "baixo|medio|alto",
+"sugestao_plano_acao": "string"
+}}
+
+Estatísticas já calculadas pelo sistema (use como contexto, não as repita no JSON):
+- total_analisado (todas as RNCs da requisição): {total}
+- status_predominante (todas as RNCs da requisição): {status_pred}
+- rncs_neste_lote (registros enviados abaixo): {total_lote}
+
+Dados de RNC (texto bruto abaixo). Atenha-se estritamente ao conteúdo fornecido:
+{texto_dados}
+"""
+
+# Segunda etapa, só quando a requisição foi dividida em lotes: funde os pareceres parciais em um só,
+# com as recorrências calculadas sobre todas as RNCs (um lote sozinho não enxerga a repetição entre lotes)
+_CONSOLIDACAO_PROMPT_TMPL = """\
+Os pareceres ao final desta mensagem foram gerados para lotes diferentes de uma mesma requisição de RNCs.
+Consolide-os em um único parecer, como se todas as RNCs tivessem sido analisadas juntas.
+
+INSTRUÇÕES OBRIGATÓRIAS PARA A CONSOLIDAÇÃO:
+1) Em 'resumo_geral':
+- Escreva no mínimo 2 parágrafos, sem repetir o mesmo fato vindo de lotes diferentes.
+- Use as recorrências globais para apontar clientes e produtos que se repetem entre lotes.
+- Cite explicitamente os códigos de produto e os clientes mencionados nos pareceres.
+
+2) Em 'principais_causas':
+- Unifique causas equivalentes escritas de formas diferentes; não crie causas que não estejam nos pareceres.
+- Ordene da mais recorrente para a menos recorrente.
+
+3) Em 'analise_de_risco':
+- Classifique como "baixo", "medio" ou "alto"; nunca abaixo do maior risco entre os pareceres parciais.
+- Justifique no texto considerando a recorrência global.
+
+4) Em 'sugestao_plano_acao':
+- Una as ações em um plano único, sem duplicidade, priorizando o que ataca as recorrências globais.
+
+IMPORTANTE:
+- Não use bullet points fora do JSON.
+- Não retorne markdown.
+- Não inclua comentários.
+- Não inclua campos extras.
+
+Retorne EXCLUSIVAMENTE em JSON, exatamente com este esquema e tipos:
+{{
+"resumo_geral": "string",
+"principais_causas": ["string", "string"],
+"analise_de_risco": "baixo|medio|alto",
+"sugestao_plano_acao": "string"
+}}
+
+Estatísticas já calculadas pelo sistema (use como contexto, não as repita no JSON):
+- total_analisado (todas as RNCs da requisição): {total}
+- status_predominante (todas as RNCs da requisição): {status_pred}
+- lotes_analisados: {total_lotes}
+- recorrencias_globais (ocorrências em todas as RNCs da requisição): {recorrencias}
+
+Pareceres parciais (JSON, um por lote):
+{pareceres}
+"""
+
+_MENSAGEM_SISTEMA = {"role": "system", "content": _SYSTEM_PROMPT}
+
+# --- 4. CACHE DE RESPOSTAS DA IA ---
+SPEED_MAP = {
+    "instant": "llama-3.1-8b-instant",
+    "balanced": "llama-3.3-70b-versatile",
+}
+LIMITE_LOTE_PEQUENO = 10  # abaixo disso o modelo 8B dá conta com TTFT bem menor
+MAX_TOKENS = 700  # suficiente para o esquema JSON fixo; limita a latência de cauda
+TEMPERATURA = 0.2
+CACHE_MAXSIZE = 512
+CACHE_TTL = 600  # segundos
+TAMANHO_LOTE = 25  # RNCs por chamada à IA; lotes maiores são divididos e analisados em paralelo
+MAX_LOTES_SIMULTANEOS = 4  # chamadas simultâneas à Groq por worker
+
+_limite_lotes = asyncio.Semaphore(MAX_LOTES_SIMULTANEOS)
+
+# Limites da conta na Groq por modelo: (requisições/min, tokens/min). O padrão é o plano gratuito;
+# contas pagas informam os seus em GROQ_LIMITES, ex.: {"llama-3.3-70b-versatile": [1000, 300000]}
+LIMITES_MODELO = {
+    "llama-3.1-8b-instant": (30, 6000),
+    "llama-3.3-70b-versatile": (30, 12000),
+}
+LIMITES_MODELO.update({modelo: tuple(limites) for modelo, limites in orjson.loads(os.getenv("GROQ_LIMITES", "{}")).items()})
+MAX_TENTATIVAS_429 = 3
+MAX_ESPERA_LIMITE = 10  # segundos que uma chamada aguarda o balde; depois disso segue e a própria Groq decide
+
+# LRU com expiração: lotes idênticos (ex.: dashboards em polling) não repetem a chamada à IA
+_cache_respostas: "OrderedDict[bytes, Tuple[float, bytes]]" = OrderedDict()
+_locks_cache: Dict[bytes, asyncio.Lock] = {}
+
+def _chave_cache(conteudo_usuario: str, modelo: str, temperatura: float) -> bytes:
+    # O prompt montado já carrega os dados do lote e as estatísticas da requisição
+    chave = hashlib.sha256(f"{modelo}|{temperatura}|".encode("utf-8"))
+    chave.update(conteudo_usuario.encode("utf-8"))
+    return chave.digest()
+
+def _cache_get(chave: bytes) -> Optional[bytes]:
+    item = _cache_respostas.get(chave)
+    if item is None:
+        return None
+    expira_em, conteudo = item
+    if expira_em < time.monotonic():
+        del _cache_respostas[chave]
+        return None
+    _cache_respostas.move_to_end(chave)
+    return conteudo
 
+def _cache_set(chave: bytes, conteudo: bytes) -> None:
+    _cache_respostas[chave] = (time.monotonic() + CACHE_TTL, conteudo)
+    _cache_respostas.move_to_end(chave)
+    while len(_cache_respostas) > CACHE_MAXSIZE:
+        _cache_respostas.popitem(last=False)
+
+# Token bucket de RPM/TPM: segura a chamada até haver requisição e tokens disponíveis
+class TokenBucket:
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requisicoes = rpm
+        self._tokens = tpm
+        self._atualizado = time.monotonic()
+
+    def _reabastecer(self) -> None:
+        agora = time.monotonic()
+        decorrido = agora - self._atualizado
+        self._atualizado = agora
+        self._requisicoes = min(self.rpm, self._requisicoes + decorrido * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + decorrido * self.tpm / 60)
+
+    async def acquire(self, tokens_estimados: int, espera_maxima: float) -> None:
+        # A reserva é feita na hora (o saldo pode ficar negativo) e a chamada espera o reabastecimento
+        # cobrir a dívida, por no máximo espera_maxima. O balde só suaviza rajadas: nunca recusa
+        # uma chamada, quem recusa de fato é a Groq (429/413)
+        self._reabastecer()
+        self._requisicoes -= 1
+        self._tokens -= tokens_estimados
+        espera = max(0.0, -self._requisicoes * 60 / self.rpm, -self._tokens * 60 / self.tpm)
+        if espera > espera_maxima:
+            # Quem desiste de esperar não deixa dívida maior que a espera que cumpriu
+            self._requisicoes = max(self._requisicoes, -espera_maxima * self.rpm / 60)
+            self._tokens = max(self._tokens, -espera_maxima * self.tpm / 60)
+            espera = espera_maxima
+        if espera:
+            await asyncio.sleep(espera)
+
+# Cada worker fica com sua fração (R/E) do limite da conta
+_buckets = {modelo: TokenBucket(rpm / WORKERS, tpm / WORKERS) for modelo, (rpm, tpm) in LIMITES_MODELO.items()}
+
+def _segundos_retry_after(headers: httpx.Headers, tentativa: int) -> float:
+    # A Groq pode mandar retry-after-ms, Retry-After em segundos ou como data HTTP
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            return float(retry_after_ms) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                data = parsedate_to_datetime(retry_after)
+                return max(0.0, (data - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        pass
+    return float(2 ** tentativa)
+
+def _escolher_modelo(total_analisado: int) -> str:
+    if total_analisado < LIMITE_LOTE_PEQUENO:
+        return SPEED_MAP["instant"]
+    return SPEED_MAP["balanced"]
+
+def _resposta_invalida(detalhe: str) -> HTTPException:
+    # Falha do modelo, não do cliente: 502 com mensagem clara em vez do erro interno do parser
+    return HTTPException(status_code=502, detail=detalhe)
+
+def _limite_excedido(espera: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Limite de uso da IA atingido; tente novamente em instantes.",
+        headers={"Retry-After": str(max(1, math.ceil(espera)))}
+    )
+
+async def _chamar_ia(modelo: str, conteudo_usuario: str) -> bytes:
+    # Estimativa pelo prompt real deste lote (~4 caracteres por token) mais a reserva de saída
+    tokens_estimados = (len(_SYSTEM_PROMPT) + len(conteudo_usuario)) // 4 + MAX_TOKENS
+
+    for tentativa in range(1, MAX_TENTATIVAS_429 + 1):
+        await _buckets[modelo].acquire(tokens_estimados, MAX_ESPERA_LIMITE)
+        try:
+            completion = await client.chat.completions.create(
+                model=modelo,
+                messages=[_MENSAGEM_SISTEMA, {"role": "user", "content": conteudo_usuario}],
+                temperature=TEMPERATURA, # Menor temperatura garante mais fidelidade aos dados
+                max_tokens=MAX_TOKENS,
+                response_format={"type": "json_object"},
+                stream=True
+            )
+            break
+        except RateLimitError as e:
+            # 429: respeita o Retry-After da Groq se a espera for curta; senão devolve o 429 ao cliente
+            espera = _segundos_retry_after(e.response.headers, tentativa)
+            if tentativa == MAX_TENTATIVAS_429 or espera > MAX_ESPERA_LIMITE:
+                raise _limite_excedido(espera)
+            await asyncio.sleep(espera)
+
+    # Os chunks são montados conforme chegam, liberando o event loop entre um e outro
+    conteudo = bytearray()
+    motivo_fim = None
+    async for chunk in completion:
+        escolha = chunk.choices[0]
+        if escolha.delta.content:
+            conteudo += escolha.delta.content.encode("utf-8")
+        motivo_fim = escolha.finish_reason or motivo_fim
+    # O último chunk traz o motivo do fim; "length" significa que o JSON foi cortado em MAX_TOKENS
+    if motivo_fim == "length":
+        raise _resposta_invalida("A resposta da IA atingiu o limite de tokens e veio incompleta.")
+    return bytes(conteudo)
+
+def _parecer_valido(conteudo: bytes) -> Parecer:
+    # Com stream e max_tokens, o JSON pode chegar cortado ou fora do esquema; só um parecer
+    # completo e com os tipos certos vai para o cache (DecodeError é um ValueError)
+    return _DECODER_PARECER.decode(conteudo)
+
+async def _obter_parecer(modelo: str, conteudo_usuario: str) -> Parecer:
+    chave = _chave_cache(conteudo_usuario, modelo, TEMPERATURA)
+    conteudo = _cache_get(chave)
+    if conteudo is not None:
+        return _DECODER_PARECER.decode(conteudo)
+
+    # Single-flight: requisições idênticas simultâneas aguardam a mesma chamada à IA
+    lock = _locks_cache.setdefault(chave, asyncio.Lock())
     try:
-        texto_dados = json.dumps([item.model_dump() for item in payload.dados_rnc], indent=2)
-
-        # Prompt com restrições severas de fidelidade aos dados
-        completion = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {
-                "role": "system",
-                "content": """
-                Você é um Auditor ISO 9001 Sênior (perfil analítico e independente). 
-                Seu objetivo é produzir um parecer técnico robusto, rastreável e baseado estritamente nos dados de RNC fornecidos.
-
-                Postura e regras:
-                - Extraia fatos objetivos e padrões; não aceite explicações vagas.
-                - Evite respostas genéricas: tudo deve estar ancorado em informações presentes nos dados.
-                - Diferencie falha pontual vs. falha sistêmica (processo/controle).
-                - Identifique tendências (recorrência por cliente, produto, etapa, motivo, setor, fornecedor, turno, operador, máquina, lote, data, ou qualquer marcador existente).
-                - Se algum campo crítico estiver ausente/ambíguo, registre explicitamente a limitação e o impacto disso na análise (sem inventar dados).
-                - Linguagem técnica e clara, sem jargões vazios.
-                - Saída obrigatória: JSON puro, sem texto fora do JSON.
-                """
-                },
-                {
-                "role": "user",
-                "content": f"""
-                Analise detalhadamente estes dados de RNC (texto bruto abaixo). Atenha-se estritamente ao conteúdo fornecido:
-                {texto_dados}
-
-                INSTRUÇÕES OBRIGATÓRIAS PARA O PARECER:
-                1) Em 'resumo_geral':
-                - Escreva no mínimo 2 parágrafos.
-                - Conecte fatos entre si (o que aconteceu, onde se repete, qual o padrão, qual o indício de falha de processo).
-                - Cite explicitamente os códigos de produto e os clientes mencionados nos dados (nomes/códigos conforme aparecerem).
-                - Aponte recorrências e padrões com base em evidências dos dados (ex.: “ocorreu X vezes”, “repetiu em datas/lotes/OPs diferentes”, “concentrado em um cliente/produto”).
-                - Se os dados não permitirem afirmar recorrência, diga isso claramente e explique o que faltou.
-                - Ignore RNC com status "Registrada".
-
-                2) Em 'principais_causas':
-                - Liste somente causas que apareçam nos dados (causa informada, descrição de falha, etapa do processo, evidência repetida).
-                - Escreva causas como frases objetivas e auditáveis (ex.: “Falta de inspeção final registrada”, “Parâmetro de processo fora do padrão”, “Matéria-prima fora de especificação”).
-                - Não invente causa raiz; se a causa estiver indefinida, registre como “Causa não determinada nos registros” e explique no resumo.
-
-                3) Em 'analise_de_risco':
-                - Classifique como "baixo", "medio" ou "alto" com base nos próprios dados.
-                - Justifique no texto (dentro do campo) considerando: recorrência, impacto no cliente, possibilidade de escape, severidade do defeito, status da RNC (aberta/fechada), e repetição por produto/cliente/lote/OP, quando houver.
-
-                4) Em 'sugestao_plano_acao':
-                - Proponha passos práticos e verificáveis, derivados das falhas relatadas e das lacunas de controle percebidas nos dados.
-                - Não cite requisitos da norma por número; descreva ações de forma operacional (ex.: “revisar ponto de controle X”, “reforçar critério de aceite”, “criar verificação de registro”, “bloquear lote até evidência”, etc.).
-                - Se não houver dados suficientes para um plano específico, proponha ações de coleta de evidência (ex.: “levantar histórico por produto/cliente”, “estratificar por causa/status”).
-
-                5) Em 'estatisticas':
-                - total_analisado: use exatamente {len(payload.dados_rnc)}.
-                - status_predominante: indique o status mais frequente encontrado nos dados (ex.: "ABERTA", "FECHADA", "EM_ANDAMENTO"). Se não existir status nos dados, retorne "NAO_INFORMADO".
-
-                IMPORTANTE:
-                - Não use bullet points fora do JSON.
-                - Não retorne markdown.
-                - Não inclua comentários.
-                - Não inclua campos extras.
-
-                Retorne EXCLUSIVAMENTE em JSON, exatamente com este esquema e tipos:
-                {{
-                "resumo_geral": "string",
-                "principais_causas": ["string", "string"],
-                "analise_de_risco": "baixo|medio|alto",
-                "sugestao_plano_acao": "string",
-                "estatisticas": {{
-                    "total_analisado": {len(payload.dados_rnc)},
-                    "status_predominante": "string"
-                }}
-                }}
-                """
-                }
-            ],
-            temperature=0.2, # Menor temperatura garante mais fidelidade aos dados
-            response_format={"type": "json_object"}
+        async with lock:
+            conteudo = _cache_get(chave)
+            if conteudo is not None:
+                return _DECODER_PARECER.decode(conteudo)
+
+            async with _limite_lotes:
+                conteudo = await _chamar_ia(modelo, conteudo_usuario)
+            try:
+                parecer = _parecer_valido(conteudo)
+            except ValueError as e:
+                logger.warning("Resposta inválida da IA (%s): %s", modelo, e)
+                raise _resposta_invalida("A IA devolveu um parecer em formato inválido; tente novamente.")
+            _cache_set(chave, conteudo)
+            return parecer
+    finally:
+        # Quem ainda aguarda o lock encontra a resposta no cache ao entrar
+        if _locks_cache.get(chave) is lock:
+            del _locks_cache[chave]
+
+# --- 5. ANALISE EM LOTES PARALELOS ---
+NIVEIS_RISCO = ("baixo", "medio", "alto")
+
+def _nivel_risco(texto: str) -> int:
+    # O campo pode vir acompanhado da justificativa ("alto - ..."), então olhamos só o início
+    inicio = texto.strip().lower().replace("é", "e")
+    for nivel in range(len(NIVEIS_RISCO) - 1, -1, -1):
+        if inicio.startswith(NIVEIS_RISCO[nivel]):
+            return nivel
+    return 0
+
+LIMITE_PREPARO_EM_THREAD = 200  # abaixo disso o salto para a thread custa mais que o próprio preparo
+TOP_RECORRENCIAS = 10  # clientes/produtos mais repetidos enviados à consolidação
+
+def _recorrencias(rncs: List[Rnc]) -> str:
+    # Contagem global por cliente e produto; RNCs "Registrada" ficam de fora, como no prompt
+    partes = []
+    for campo, rotulo in (("CLIENTE", "clientes"), ("COD_PRODUTO", "produtos")):
+        contagem = Counter(
+            getattr(r, campo) for r in rncs
+            if getattr(r, campo) and r.STATUS.upper() != "REGISTRADA"
         )
+        repetidos = [f"{valor} ({n}x)" for valor, n in contagem.most_common(TOP_RECORRENCIAS) if n > 1]
+        partes.append(f"{rotulo}: {', '.join(repetidos) or 'nenhuma repetição'}")
+    return "; ".join(partes)
 
-        return json.loads(completion.choices[0].message.content)
+def _preparar(rncs: List[Rnc]) -> Tuple[str, str, List[str]]:
+    # Parte CPU da requisição: normalização, estatística local e montagem do prompt de cada lote
+    rncs, status_pred = _normalizar(rncs)
+    lotes = [rncs[i:i + TAMANHO_LOTE] for i in range(0, len(rncs), TAMANHO_LOTE)]
+    prompts = [
+        _USER_PROMPT_TMPL.format(
+            texto_dados=_ENCODER.encode(lote).decode("utf-8"),
+            total=len(rncs),
+            status_pred=status_pred,
+            total_lote=len(lote)
+        )
+        for lote in lotes
+    ]
+    # As recorrências só servem à consolidação, que só existe com mais de um lote
+    recorrencias = _recorrencias(rncs) if len(lotes) > 1 else ""
+    return status_pred, recorrencias, prompts
+
+def _juntar(parciais: List[Parecer]) -> Parecer:
+    # Junção local, usada só se a consolidação pela IA falhar: causas em ordem de aparição, sem repetição
+    causas = dict.fromkeys(c for p in parciais for c in p.principais_causas)
+    risco = max((p.analise_de_risco for p in parciais), key=_nivel_risco)
+    planos = dict.fromkeys(p.sugestao_plano_acao for p in parciais if p.sugestao_plano_acao)
+    return Parecer(
+        resumo_geral="\n\n".join(p.resumo_geral for p in parciais if p.resumo_geral),
+        principais_causas=list(causas),
+        analise_de_risco=risco,
+        sugestao_plano_acao="\n\n".join(planos)
+    )
+
+async def _consolidar(modelo: str, parciais: List[Parecer], total_analisado: int, status_pred: str, recorrencias: str) -> Parecer:
+    if len(parciais) == 1:
+        return parciais[0]
+
+    conteudo_usuario = _CONSOLIDACAO_PROMPT_TMPL.format(
+        total=total_analisado,
+        status_pred=status_pred,
+        total_lotes=len(parciais),
+        recorrencias=recorrencias,
+        pareceres=_ENCODER.encode(parciais).decode("utf-8")
+    )
+    try:
+        return await _obter_parecer(modelo, conteudo_usuario)
+    except HTTPException as e:
+        # Parecer da consolidação cortado ou fora do esquema: os parciais já estão validados,
+        # então a junção local ainda entrega um resultado. 429 e demais erros seguem para o cliente
+        if e.status_code != 502:
+            raise
+        logger.warning("Consolidação pela IA falhou (%s); usando a junção local dos pareceres", e.detail)
+        return _juntar(parciais)
+
+# --- 6. LOGICA PRINCIPAL COM FILTRO DE DADOS ---
+# Resposta fixa para payload vazio, serializada uma única vez no import.
+# O Starlette não altera o Response ao enviá-lo, então a mesma instância é reaproveitada
+_EMPTY_BYTES = orjson.dumps({
+    "resumo_geral": "Não foram identificados registros de Não Conformidade (RNC) para os parâmetros selecionados. Os processos operam dentro da normalidade estatística.",
+    "principais_causas": ["Operação estável"],
+    "analise_de_risco": "baixo",
+    "sugestao_plano_acao": "Manter protocolos de monitoramento preventivo.",
+    "estatisticas": {
+        "total_analisado": 0,
+        "status_predominante": "N/A"
+    }
+})
+_EMPTY_RESP = Response(content=_EMPTY_BYTES, media_type="application/json")
+
+@app.post(
+    "/analise-rnc",
+    response_class=Response,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": _SCHEMA_REQUISICAO}}
+        }
+    }
+)
+async def analise_rnc(request: Request):
+    try:
+        payload = _DECODER.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise RequestValidationError(_erros_validacao(e))
+
+    rncs = payload.dados_rnc
+    total_analisado = len(rncs)
+
+    # FILTRO PREVENTIVO: Se não há dados, retornamos a resposta fixa sem chamar a IA
+    if not total_analisado:
+        logger.debug("Sistema estável: 0 RNCs processadas.")
+        return _EMPTY_RESP
+
+    # O modelo é escolhido pelo tamanho da requisição inteira, para todos os lotes falarem com o mesmo
+    modelo = _escolher_modelo(total_analisado)
+
+    # Agregados triviais são calculados aqui, sem gastar tokens do modelo
+    # Payloads grandes são preparados fora do event loop para não travar as outras requisições
+    if total_analisado > LIMITE_PREPARO_EM_THREAD:
+        status_pred, recorrencias, prompts = await asyncio.to_thread(_preparar, rncs)
+    else:
+        status_pred, recorrencias, prompts = _preparar(rncs)
+
+    try:
+        parciais = await asyncio.gather(*(_obter_parecer(modelo, prompt) for prompt in prompts))
+        parecer = await _consolidar(modelo, parciais, total_analisado, status_pred, recorrencias)
+
+        resultado = msgspec.structs.asdict(parecer)
+        resultado["estatisticas"] = {
+            "total_analisado": total_analisado,
+            "status_predominante": status_pred
+        }
+        # Bytes já serializados: o FastAPI devolve direto, sem jsonable_encoder nem nova codificação
+        return Response(content=orjson.dumps(resultado), media_type="application/json")
 
+    except HTTPException:
+        raise
+    except APIStatusError as e:
+        if e.status_code != 413:
+            logger.error("Erro: %s", e)
+            raise HTTPException(status_code=500, detail=str(e))
+        # Lote maior do que a Groq aceita para o modelo: repassa a recusa em vez de mascarar como 500
+        raise HTTPException(status_code=413, detail="Lote de RNCs grande demais para o modelo de IA.")
     except Exception as e:
-        logger.error(f"Erro: {str(e)}")
+        logger.error("Erro: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    WORKERS = int(os.getenv("WEB_CONCURRENCY", max(2, os.cpu_count() or 1)))
+    # Os workers herdam a variável e dividem o limite da Groq pelo número certo de processos
+    os.environ["WEB_CONCURRENCY"] = str(WORKERS)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WORKERS,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        log_level="warning"
+    )
\ No newline at end of file
@@ -4,7 +4,7 @@ import logging
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 from dotenv import load_dotenv
 import ollama # <--- Motor Local
 
@@ -16,6 +16,9 @@ logger = logging.getLogger(__name__)
 # Endereço do seu servidor Ollama na rede
 OLLAMA_HOST = "http://10.0.3.2:11434"
 
+# Cliente assíncrono único: não bloqueia o event loop durante a geração
+client = ollama.AsyncClient(host=OLLAMA_HOST)
+
 app = FastAPI(title="Analista de RNC Local v3.0")
 
 app.add_middleware(
@@ -28,6 +31,9 @@ app.add_middleware(
 
 # 2. MODELO DE DADOS
 class Rnc(BaseModel):
+    # O trim roda no pydantic-core (Rust), sem um validator Python por campo
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     RNC: str
     ANO: str
     PRIORIDADE: str
@@ -41,16 +47,12 @@ class Rnc(BaseModel):
     CONCLUSAO: Optional[str] = None
     DEPARTAMENTO_DESTINO: str
 
-    @field_validator('*', mode='before')
-    @classmethod
-    def trim_string(cls, v):
-        if isinstance(v, str):
-            return v.strip()
-        return v
-
 class RequisicaoAnalista(BaseModel):
     dados_rnc: List[Rnc]
 
+# Serializa a lista inteira direto no pydantic-core, sem montar dicts intermediários
+_RNC_LIST_ADAPTER = TypeAdapter(List[Rnc])
+
 # 3. ENDPOINT USANDO QWEN-2.5:7B LOCAL
 @app.post("/analise-rnc")
 async def analise_rnc(payload: RequisicaoAnalista):
@@ -73,13 +75,10 @@ async def analise_rnc(payload: RequisicaoAnalista):
 
     try:
         # Prepara os dados
-        texto_dados = json.dumps([item.model_dump() for item in payload.dados_rnc], indent=2)
-
-        # Configura o cliente para o IP correto
-        client = ollama.Client(host=OLLAMA_HOST)
+        texto_dados = _RNC_LIST_ADAPTER.dump_json(payload.dados_rnc).decode("utf-8")
 
         # Chamada ao modelo local
-        response = client.chat(
+        response = await client.chat(
             model='llama3.2:latest',
             messages=[
                 {
@@ -0,0 +1,56 @@
+import importlib.util
+from pathlib import Path
+
+import orjson
+
+RAIZ = Path(__file__).resolve().parent.parent
+
+def _carregar(nome: str, caminho: Path):
+    # main.py e old/main.py têm o mesmo nome de módulo, então cada um é carregado pelo caminho
+    spec = importlib.util.spec_from_file_location(nome, caminho)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+main = _carregar("main_groq", RAIZ / "main.py")
+old_main = _carregar("main_ollama", RAIZ / "old" / "main.py")
+
+RNC_COM_ESPACOS = {
+    "RNC": "  123 ",
+    "ANO": "2024\n",
+    "PRIORIDADE": "\tAlta",
+    "COD_PRODUTO": " PRD-001 ",
+    "CLASSIFICACAO": "Produto",
+    "DESCRICAO": "  Peça com rebarba  ",
+    "ORIGEM": "Cliente ",
+    "CLIENTE": "  ACME Ltda ",
+    "STATUS": " aberta ",
+    "REGISTRO": "2024-05-01",
+    "CONCLUSAO": None,
+    "DEPARTAMENTO_DESTINO": " Qualidade",
+}
+
+def test_normalizar_apara_campos_decodificados():
+    payload = main._DECODER.decode(orjson.dumps({"dados_rnc": [RNC_COM_ESPACOS, dict(RNC_COM_ESPACOS, STATUS="Fechada")]}))
+    rncs, status_pred = main._normalizar(payload.dados_rnc)
+
+    for campo, valor in RNC_COM_ESPACOS.items():
+        if isinstance(valor, str):
+            assert getattr(rncs[0], campo) == valor.strip()
+    assert rncs[0].CONCLUSAO is None
+    assert rncs[1].STATUS == "Fechada"
+    assert status_pred == "ABERTA"
+
+def test_normalizar_preserva_registros_ja_limpos():
+    payload = main._DECODER.decode(orjson.dumps({"dados_rnc": [{k: v.strip() if isinstance(v, str) else v for k, v in RNC_COM_ESPACOS.items()}]}))
+    rncs, _ = main._normalizar(payload.dados_rnc)
+
+    # Sem espaços sobrando o registro não é recriado
+    assert rncs[0] is payload.dados_rnc[0]
+
+def test_rnc_antigo_apara_campos_na_validacao():
+    rnc = old_main.Rnc.model_validate(RNC_COM_ESPACOS)
+
+    for campo, valor in RNC_COM_ESPACOS.items():
+        if isinstance(valor, str):
+            assert getattr(rnc, campo) == valor.strip()